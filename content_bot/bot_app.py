@@ -2,12 +2,18 @@
 
 from __future__ import annotations
 
+import asyncio
+import contextlib
+import functools
 import logging
+import ssl
+import time
 from types import SimpleNamespace
-from typing import Callable
+from typing import Any, AsyncIterator, Awaitable, Callable
 
-import requests
-from telebot import TeleBot, apihelper, types as tb_types
+from redis.asyncio import Redis
+from telebot import asyncio_helper, types as tb_types
+from telebot.async_telebot import AsyncTeleBot
 
 from .gigachat import GigaChatClient, GigaChatConfig, GigaChatError
 from .parsing import IdeaParsingError, parse_ideas
@@ -24,6 +30,42 @@ from .state import Idea, StateManager
 logger = logging.getLogger(__name__)
 
 
+# Частота правок сообщения при потоковой генерации: Telegram ограничивает
+# редактирование примерно одним разом в секунду на чат.
+STREAM_EDIT_MIN_CHARS = 24
+STREAM_EDIT_INTERVAL = 0.8
+
+# Telegram делит длинные вставки (>4096 символов) на несколько сообщений.
+# Сообщения, пришедшие подряд в пределах окна, склеиваются в один ответ;
+# после длинного куска ждём дольше — скорее всего, следом идёт продолжение.
+TEXT_BATCH_DELAY = 0.3
+TEXT_BATCH_LONG_DELAY = 1.0
+TEXT_BATCH_LONG_THRESHOLD = 4000
+
+
+GREETING_TEMPLATE = (
+    "Привет, {name}! 👋\n"
+    "Я — бот для генерации контент-идей: за три шага соберу исходные данные (нишу, цель и формат), предложу 5 идей и превращу выбранную в готовый пост. "
+    "Если нужна подсказка — напиши /help.\n"
+    "А сейчас расскажи, для какой ниши нужен контент."
+)
+
+HELP_TEXT = (
+    "ℹ️ Этот бот — MVP генератора контента.\n\n"
+    "Как он работает:\n"
+    "1. Спрашивает нишу, цель и формат.\n"
+    "2. Генерирует 5 релевантных идей с краткими описаниями.\n"
+    "3. Превращает выбранную идею в оформленный Markdown-пост с призывом к действию.\n\n"
+    "Команды:\n"
+    "/start — запустить сценарий заново.\n"
+    "/help — показать эту подсказку."
+)
+
+ASK_NICHE = "Начнём! Напишите, для какой ниши нужен контент (например: фитнес, образование, бизнес и т.д.)."
+ASK_GOAL = "Спасибо! Теперь укажите цель контента (например: привлечь аудиторию, обучить, продать и т.д.)."
+ASK_FORMAT = "Отлично. Какой формат интересует? (например: пост в соцсетях, статья и т.д.)."
+
+
 def format_parameters(niche: str, goal: str, content_format: str) -> str:
     return (
         "Ваши параметры:\n"
@@ -34,33 +76,58 @@ def format_parameters(niche: str, goal: str, content_format: str) -> str:
 
 
 def format_ideas(ideas: list[Idea]) -> str:
-    lines = ["Вот 5 идей:"]
-    for index, idea in enumerate(ideas, start=1):
-        lines.append(f"{index}. *{idea.title}* — {idea.description}")
-    lines.append("\nВыберите идею, ответив номером или кнопкой ниже.")
-    return "\n".join(lines)
+    body = "\n".join(
+        f"{index}. *{idea.title}* — {idea.description}"
+        for index, idea in enumerate(ideas, start=1)
+    )
+    return f"Вот 5 идей:\n{body}\n\nВыберите идею, ответив номером или кнопкой ниже."
 
 
-def _build_number_keyboard(count: int, callback_prefix: str) -> tb_types.InlineKeyboardMarkup:
+# Клавиатуры статичны, поэтому храним их уже сериализованными в JSON:
+# telebot передаёт строку в reply_markup как есть.
+@functools.lru_cache(maxsize=16)
+def _build_number_keyboard(count: int, callback_prefix: str) -> str:
     keyboard = tb_types.InlineKeyboardMarkup(row_width=5)
     buttons = [
         tb_types.InlineKeyboardButton(str(i), callback_data=f"{callback_prefix}:{i}")
         for i in range(1, count + 1)
     ]
     keyboard.add(*buttons)
-    return keyboard
+    return keyboard.to_json()
 
 
-def _build_restart_keyboard() -> tb_types.InlineKeyboardMarkup:
+def _build_restart_keyboard() -> str:
     keyboard = tb_types.InlineKeyboardMarkup()
     keyboard.add(
         tb_types.InlineKeyboardButton("Сгенерировать новый набор", callback_data="action:new"),
         tb_types.InlineKeyboardButton("О боте", callback_data="action:about"),
     )
-    return keyboard
+    return keyboard.to_json()
+
+
+def _build_generate_keyboard() -> str:
+    keyboard = tb_types.InlineKeyboardMarkup()
+    keyboard.add(tb_types.InlineKeyboardButton("Сгенерировать идеи", callback_data="action:generate"))
+    return keyboard.to_json()
+
+
+_RESTART_KEYBOARD = _build_restart_keyboard()
+_GENERATE_KEYBOARD = _build_generate_keyboard()
+
 
+def get_update_handler(bot: AsyncTeleBot) -> Callable[[dict[str, Any]], Awaitable[None]]:
+    """Return a coroutine function feeding raw webhook payloads into the bot."""
+
+    async def handle_update(payload: dict[str, Any]) -> None:
+        update = tb_types.Update.de_json(payload)
+        await bot.process_new_updates([update])
+
+    return handle_update
+
+
+def create_app() -> tuple[AsyncTeleBot, Callable[[], Awaitable[None]]]:
+    """Build the bot and return it with a coroutine function releasing its resources."""
 
-def create_app() -> TeleBot:
     try:
         settings = get_settings()
     except MissingSettingError as exc:
@@ -69,15 +136,18 @@ def create_app() -> TeleBot:
         ) from exc
 
     if settings.telegram_disable_ssl_verify:
-        session = requests.Session()
-        session.verify = False
-        apihelper.session = session
+        ssl_context = ssl.create_default_context()
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+        asyncio_helper.session_manager.ssl_context = ssl_context
         logger.warning(
             "TELEGRAM_DISABLE_SSL_VERIFY=true — проверка SSL отключена. Используйте только для диагностики."
         )
 
-    bot = TeleBot(settings.telegram_bot_token, parse_mode="Markdown")
-    state_manager = StateManager()
+    redis = Redis.from_url(settings.redis_url) if settings.redis_url else None
+
+    bot = AsyncTeleBot(settings.telegram_bot_token, parse_mode="Markdown")
+    state_manager = StateManager(redis)
 
     verify_ssl = settings.gigachat_verify_ssl
     if verify_ssl is True:
@@ -90,112 +160,117 @@ def create_app() -> TeleBot:
             client_id=settings.gigachat_client_id,
             client_secret=settings.gigachat_client_secret,
             verify_ssl=verify_ssl,
-        )
+        ),
+        redis=redis,
     )
 
-    def with_state(handler: Callable):
-        def wrapper(message):
+    def with_state(handler: Callable[..., Awaitable[None]]):
+        async def wrapper(message):
             user_id = message.from_user.id
-            state = state_manager.get(user_id)
-            return handler(message, state)
+            state = await state_manager.get(user_id)
+            return await handler(message, state)
 
         return wrapper
 
-    def ask_niche(chat_id: int) -> None:
-        bot.send_message(
-            chat_id,
-            "Начнём! Напишите, для какой ниши нужен контент (например: фитнес, образование, бизнес и т.д.).",
-        )
+    async def ask_niche(chat_id: int) -> None:
+        await bot.send_message(chat_id, ASK_NICHE)
 
-    def ask_goal(chat_id: int) -> None:
-        bot.send_message(
-            chat_id,
-            "Спасибо! Теперь укажите цель контента (например: привлечь аудиторию, обучить, продать и т.д.).",
-        )
+    async def ask_goal(chat_id: int) -> None:
+        await bot.send_message(chat_id, ASK_GOAL)
 
-    def ask_format(chat_id: int) -> None:
-        bot.send_message(
-            chat_id,
-            "Отлично. Какой формат интересует? (например: пост в соцсетях, статья и т.д.).",
-        )
+    async def ask_format(chat_id: int) -> None:
+        await bot.send_message(chat_id, ASK_FORMAT)
 
-    def show_parameters(chat_id: int, state) -> None:
-        keyboard = tb_types.InlineKeyboardMarkup()
-        keyboard.add(tb_types.InlineKeyboardButton("Сгенерировать идеи", callback_data="action:generate"))
-        bot.send_message(
+    async def show_parameters(chat_id: int, state) -> None:
+        await bot.send_message(
             chat_id,
             format_parameters(state.niche, state.goal, state.content_format),
-            reply_markup=keyboard,
+            reply_markup=_GENERATE_KEYBOARD,
         )
 
-    help_text = (
-        "ℹ️ Этот бот — MVP генератора контента.\n\n"
-        "Как он работает:\n"
-        "1. Спрашивает нишу, цель и формат.\n"
-        "2. Генерирует 5 релевантных идей с краткими описаниями.\n"
-        "3. Превращает выбранную идею в оформленный Markdown-пост с призывом к действию.\n\n"
-        "Команды:\n"
-        "/start — запустить сценарий заново.\n"
-        "/help — показать эту подсказку."
-    )
+    async def stream_post(chat_id: int, message_id: int, chunks: AsyncIterator[str]) -> str:
+        parts: list[str] = []
+        pending = 0
+        last_edit = time.monotonic()
+        async for delta in chunks:
+            parts.append(delta)
+            pending += len(delta)
+            now = time.monotonic()
+            if pending >= STREAM_EDIT_MIN_CHARS and now - last_edit >= STREAM_EDIT_INTERVAL:
+                try:
+                    # Промежуточный текст отправляем без Markdown: разметка может быть незакрыта.
+                    await bot.edit_message_text("".join(parts), chat_id, message_id, parse_mode="")
+                except asyncio_helper.ApiTelegramException:
+                    logger.debug("Не удалось обновить сообщение с черновиком поста", exc_info=True)
+                pending = 0
+                last_edit = now
+        return "".join(parts).strip()
+
+    pending_text: dict[int, list[str]] = {}
+    flush_tasks: dict[int, asyncio.Task[None]] = {}
+
+    def drop_pending_text(user_id: int) -> None:
+        # Текст, отправленный до сброса сценария, не должен стать ответом нового шага.
+        pending_text.pop(user_id, None)
+        task = flush_tasks.pop(user_id, None)
+        if task is not None:
+            task.cancel()
 
     @bot.message_handler(commands=["start"])
-    def handle_start(message):
+    async def handle_start(message):
         user_id = message.from_user.id
-        state_manager.reset(user_id)
-        greeting = (
-            f"Привет, {message.from_user.first_name or 'друг'}! 👋\n"
-            "Я — бот для генерации контент-идей: за три шага соберу исходные данные (нишу, цель и формат), предложу 5 идей и превращу выбранную в готовый пост. "
-            "Если нужна подсказка — напиши /help.\n"
-            "А сейчас расскажи, для какой ниши нужен контент."
-        )
-        bot.send_message(message.chat.id, greeting)
-        ask_niche(message.chat.id)
+        drop_pending_text(user_id)
+        await state_manager.reset(user_id)
+        greeting = GREETING_TEMPLATE.format(name=message.from_user.first_name or "друг")
+        await bot.send_message(message.chat.id, greeting)
+        await ask_niche(message.chat.id)
 
     @bot.message_handler(commands=["help"])
-    def handle_help(message):
-        bot.send_message(message.chat.id, help_text)
-
-    @bot.callback_query_handler(func=lambda call: call.data == "action:new")
-    def handle_new(call):
-        state_manager.reset(call.from_user.id)
-        bot.answer_callback_query(call.id)
-        bot.send_message(
+    async def handle_help(message):
+        await bot.send_message(message.chat.id, HELP_TEXT)
+
+    async def handle_new(call):
+        drop_pending_text(call.from_user.id)
+        await state_manager.reset(call.from_user.id, fresh_completions=True)
+        await bot.answer_callback_query(call.id)
+        await bot.send_message(
             call.message.chat.id,
             "🔄 Запускаем сценарий заново. Напиши нишу, чтобы начать новый набор идей.",
         )
-        ask_niche(call.message.chat.id)
+        await ask_niche(call.message.chat.id)
 
-    @bot.callback_query_handler(func=lambda call: call.data == "action:about")
-    def handle_about(call):
-        bot.answer_callback_query(call.id)
-        bot.send_message(call.message.chat.id, help_text)
+    async def handle_about(call):
+        await bot.answer_callback_query(call.id)
+        await bot.send_message(call.message.chat.id, HELP_TEXT)
 
-    @bot.callback_query_handler(func=lambda call: call.data == "action:generate")
-    def handle_generate(call):
-        bot.answer_callback_query(call.id)
+    async def handle_generate(call):
+        await bot.answer_callback_query(call.id)
         user_id = call.from_user.id
-        state = state_manager.get(user_id)
+        state = await state_manager.get(user_id)
         if not all([state.niche, state.goal, state.content_format]):
-            bot.send_message(
+            await bot.send_message(
                 call.message.chat.id,
                 "Не все параметры заданы. Давайте начнём заново командой /start.",
             )
             return
 
-        bot.send_chat_action(call.message.chat.id, "typing")
-        bot.send_message(call.message.chat.id, "Генерирую идеи, это займёт несколько секунд...")
+        started_step = state.step
+        await bot.send_chat_action(call.message.chat.id, "typing")
+        await bot.send_message(call.message.chat.id, "Генерирую идеи, это займёт несколько секунд...")
 
         try:
-            response = gigachat.generate_completion(
+            response = await gigachat.generate_completion(
                 IDEA_SYSTEM_PROMPT,
                 build_idea_prompt(state.niche, state.goal, state.content_format),
                 temperature=0.9,
+                # В кеш попадает только ответ, из которого удалось разобрать идеи.
+                validate=parse_ideas,
+                read_cache=not state.fresh_completions,
             )
             ideas = parse_ideas(response)
         except (GigaChatError, IdeaParsingError) as exc:
             logger.exception("Не удалось получить идеи")
-            bot.send_message(
+            await bot.send_message(
                 call.message.chat.id,
                 "Произошла ошибка при генерации идей. Попробуйте снова командой /start.",
             )
@@ -203,88 +278,168 @@ def create_app() -> TeleBot:
 
         state.ideas = ideas
         state.step = "waiting_idea_selection"
+        # Пока шла генерация, пользователь мог перезапустить сценарий — тогда идеи устарели.
+        if not await state_manager.save_if_current(user_id, state, started_step):
+            logger.info("Сценарий пользователя %s сменился, идеи отброшены", user_id)
+            return
 
         keyboard = _build_number_keyboard(len(ideas), "pick")
-        bot.send_message(
+        await bot.send_message(
             call.message.chat.id,
             format_ideas(ideas),
             reply_markup=keyboard,
         )
 
-    @bot.callback_query_handler(func=lambda call: call.data.startswith("pick:"))
-    def handle_pick(call):
-        bot.answer_callback_query(call.id)
+    async def handle_pick(call):
+        await bot.answer_callback_query(call.id)
         user_id = call.from_user.id
-        state = state_manager.get(user_id)
+        state = await state_manager.get(user_id)
         if state.step != "waiting_idea_selection" or not state.ideas:
-            bot.send_message(call.message.chat.id, "Похоже, идеи ещё не готовы. Нажмите /start.")
+            await bot.send_message(call.message.chat.id, "Похоже, идеи ещё не готовы. Нажмите /start.")
             return
 
         try:
-            selected_index = int(call.data.split(":", 1)[1]) - 1
+            selected_index = int(call.data.partition(":")[2]) - 1
         except ValueError:
-            bot.send_message(call.message.chat.id, "Не удалось понять номер идеи. Попробуйте снова.")
+            await bot.send_message(call.message.chat.id, "Не удалось понять номер идеи. Попробуйте снова.")
             return
 
         if selected_index < 0 or selected_index >= len(state.ideas):
-            bot.send_message(call.message.chat.id, "Такой идеи нет. Выберите номер из списка.")
+            await bot.send_message(call.message.chat.id, "Такой идеи нет. Выберите номер из списка.")
             return
 
         state.selected_index = selected_index
         idea = state.ideas[selected_index]
         state.step = "generating_post"
+        if not await state_manager.save_if_current(user_id, state, "waiting_idea_selection"):
+            return
 
-        bot.send_chat_action(call.message.chat.id, "typing")
-        bot.send_message(call.message.chat.id, "Отличный выбор! Собираю готовый пост...")
+        await bot.send_chat_action(call.message.chat.id, "typing")
+        placeholder = await bot.send_message(
+            call.message.chat.id, "Отличный выбор! Собираю готовый пост..."
+        )
 
+        chunks = gigachat.stream_completion(
+            POST_SYSTEM_PROMPT,
+            build_post_prompt(
+                state.niche,
+                state.goal,
+                state.content_format,
+                idea.title,
+                idea.description,
+            ),
+            temperature=0.8,
+            read_cache=not state.fresh_completions,
+        )
         try:
-            post_text = gigachat.generate_completion(
-                POST_SYSTEM_PROMPT,
-                build_post_prompt(
-                    state.niche,
-                    state.goal,
-                    state.content_format,
-                    idea.title,
-                    idea.description,
-                ),
-                temperature=0.8,
-            )
+            # aclosing закрывает поток и освобождает соединение при любой ошибке обработчика.
+            async with contextlib.aclosing(chunks):
+                post_text = await stream_post(call.message.chat.id, placeholder.message_id, chunks)
         except GigaChatError:
             logger.exception("Ошибка генерации поста")
-            bot.send_message(
+            await bot.send_message(
                 call.message.chat.id,
                 "Не удалось получить текст поста. Попробуйте снова командой /start.",
             )
             return
 
         state.step = "finished"
-        bot.send_message(
-            call.message.chat.id,
-            f"Готово! Вот ваш пост:\n\n{post_text}",
-            reply_markup=_build_restart_keyboard(),
-        )
+        if not await state_manager.save_if_current(user_id, state, "generating_post"):
+            logger.info("Сценарий пользователя %s сменился, пост не сохранён", user_id)
+            return
+        final_text = f"Готово! Вот ваш пост:\n\n{post_text}"
+        try:
+            await bot.edit_message_text(
+                final_text,
+                call.message.chat.id,
+                placeholder.message_id,
+                reply_markup=_RESTART_KEYBOARD,
+            )
+        except asyncio_helper.ApiTelegramException:
+            logger.warning("Пост не удалось отформатировать в Markdown, отправляю как есть")
+            await bot.edit_message_text(
+                final_text,
+                call.message.chat.id,
+                placeholder.message_id,
+                parse_mode="",
+                reply_markup=_RESTART_KEYBOARD,
+            )
+
+    action_handlers: dict[str, Callable[[Any], Awaitable[None]]] = {
+        "new": handle_new,
+        "about": handle_about,
+        "generate": handle_generate,
+    }
+
+    async def handle_action(call) -> None:
+        handler = action_handlers.get(call.data.partition(":")[2])
+        if handler is None:
+            await bot.answer_callback_query(call.id)
+            return
+        await handler(call)
+
+    callback_handlers: dict[str, Callable[[Any], Awaitable[None]]] = {
+        "action": handle_action,
+        "pick": handle_pick,
+    }
+
+    # Один обработчик на все кнопки: маршрут выбирается по префиксу callback_data.
+    @bot.callback_query_handler(func=lambda call: bool(call.data))
+    async def handle_callback(call):
+        handler = callback_handlers.get(call.data.partition(":")[0])
+        if handler is None:
+            await bot.answer_callback_query(call.id)
+            return
+        await handler(call)
+
+    async def flush_text_after(message, delay: float) -> None:
+        await asyncio.sleep(delay)
+        user_id = message.from_user.id
+        # Снимаем задачу из словаря до обработки, чтобы новое сообщение её уже не отменило.
+        flush_tasks.pop(user_id, None)
+        message.text = "\n".join(pending_text.pop(user_id, []))
+        try:
+            await process_text(message)
+        except Exception:
+            logger.exception("Ошибка обработки текстового сообщения")
 
     @bot.message_handler(content_types=["text"])
+    async def handle_text(message):
+        if message.entities and any(ent.type == "bot_command" for ent in message.entities):
+            return
+
+        user_id = message.from_user.id
+        pending_text.setdefault(user_id, []).append(message.text)
+        previous = flush_tasks.get(user_id)
+        if previous is not None:
+            previous.cancel()
+        delay = (
+            TEXT_BATCH_LONG_DELAY
+            if len(message.text) >= TEXT_BATCH_LONG_THRESHOLD
+            else TEXT_BATCH_DELAY
+        )
+        flush_tasks[user_id] = asyncio.create_task(flush_text_after(message, delay))
+
     @with_state
-    def handle_text(message, state):
+    async def process_text(message, state):
         user_input = message.text.strip()
         chat_id = message.chat.id
 
-        if message.entities and any(ent.type == "bot_command" for ent in message.entities):
-            return
-
         if state.step == "waiting_niche":
             state.niche = user_input
             state.step = "waiting_goal"
-            ask_goal(chat_id)
+            await state_manager.save(message.from_user.id, state)
+            await ask_goal(chat_id)
         elif state.step == "waiting_goal":
             state.goal = user_input
             state.step = "waiting_format"
-            ask_format(chat_id)
+            await state_manager.save(message.from_user.id, state)
+            await ask_format(chat_id)
         elif state.step == "waiting_format":
             state.content_format = user_input
             state.step = "ready_to_generate"
-            show_parameters(chat_id, state)
+            await state_manager.save(message.from_user.id, state)
+            await show_parameters(chat_id, state)
         elif state.step == "waiting_idea_selection" and user_input.isdigit():
             # Поддержка текстового ввода номера идеи.
             fake_call = SimpleNamespace(
@@ -293,12 +448,18 @@ def create_app() -> TeleBot:
                 message=message,
                 data=f"pick:{user_input}",
             )
-            handle_pick(fake_call)  # type: ignore[arg-type]
+            await handle_pick(fake_call)  # type: ignore[arg-type]
         else:
-            bot.send_message(
+            await bot.send_message(
                 chat_id,
                 "Не понял сообщение. Используйте /start, чтобы начать заново.",
             )
 
-    return bot
+    async def close() -> None:
+        await gigachat.aclose()
+        if redis is not None:
+            await redis.aclose()
+        await bot.close_session()
+
+    return bot, close
 
@@ -2,25 +2,34 @@
 
 from __future__ import annotations
 
+import asyncio
 import base64
+import contextlib
 import datetime as dt
+import hashlib
 import logging
+import time
 import uuid
 from dataclasses import dataclass
-from typing import Optional
+from typing import Any, AsyncIterator, Callable, Iterable, Optional
 
-import requests
-import urllib3
+import httpx
+import msgspec
+from cachetools import TTLCache
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
 
 
 logger = logging.getLogger(__name__)
 
 
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-
-
 TOKEN_URL = "https://ngw.devices.sberbank.ru:9443/api/v2/oauth"
 CHAT_URL = "https://gigachat.devices.sberbank.ru/api/v1/chat/completions"
+COMPLETION_CACHE_PREFIX = "gigachat:completion:"
+TOKEN_CACHE_KEY = "gigachat:token"
+TOKEN_LOCK_KEY = "gigachat:refresh"
+TOKEN_REFRESH_MARGIN = 60.0
+TOKEN_RETRY_DELAY = 30.0
 
 
 @dataclass
@@ -31,50 +40,148 @@ class GigaChatConfig:
     model: str = "GigaChat"
     timeout: float = 60.0
     verify_ssl: bool | str = False  # Значение по умолчанию, если параметр не передан в GigaChatConfig. В продакшене задаётся через GIGACHAT_VERIFY_SSL в .env
+    cache_maxsize: int = 10_000
+    cache_ttl: int = 24 * 60 * 60  # 0 отключает кеш ответов
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    max_concurrency: int = 10  # одновременных запросов к chat completions
 
 
 class GigaChatError(RuntimeError):
     """Raised when the API returns an error response."""
 
 
+class _SharedToken(msgspec.Struct):
+    token: str
+    expires_at: float  # Unix-время, общее для всех процессов
+
+
 class GigaChatClient:
-    def __init__(self, config: GigaChatConfig) -> None:
+    def __init__(self, config: GigaChatConfig, redis: Optional[Redis] = None) -> None:
         self._config = config
-        self._session = requests.Session()
+        self._redis = redis
+        self._basic_auth = base64.b64encode(
+            f"{config.client_id}:{config.client_secret}".encode("utf-8")
+        ).decode("utf-8")
+        self._cache: Optional[TTLCache[bytes, str]] = (
+            TTLCache(maxsize=config.cache_maxsize, ttl=config.cache_ttl)
+            if config.cache_ttl > 0
+            else None
+        )
+        self._session = httpx.AsyncClient(
+            verify=config.verify_ssl,
+            timeout=config.timeout,
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=config.max_connections,
+                max_keepalive_connections=config.max_keepalive_connections,
+            ),
+        )
         self._access_token: Optional[str] = None
-        self._token_expires_at: Optional[dt.datetime] = None
+        self._token_expires_at_monotonic = 0.0
+        self._token_expires_at_wall = 0.0
+        self._token_lock = asyncio.Lock()
+        self._refresh_task: Optional[asyncio.Task[None]] = None
+        self._semaphore = asyncio.Semaphore(config.max_concurrency)
 
     def _token_is_valid(self) -> bool:
-        if not self._access_token or not self._token_expires_at:
+        return (
+            self._access_token is not None
+            and time.monotonic() < self._token_expires_at_monotonic - 30
+        )
+
+    def _set_token_lifetime(self, seconds: float) -> None:
+        self._token_expires_at_monotonic = time.monotonic() + seconds
+        self._token_expires_at_wall = time.time() + seconds
+
+    async def _load_shared_token(self) -> bool:
+        """Adopt a token another worker stored in Redis, if it is still fresh."""
+
+        assert self._redis is not None
+        try:
+            data = await self._redis.get(TOKEN_CACHE_KEY)
+        except RedisError:
+            logger.warning("Не удалось прочитать токен GigaChat из Redis", exc_info=True)
             return False
-        return dt.datetime.utcnow() < self._token_expires_at - dt.timedelta(seconds=30)
+        if data is None:
+            return False
+        try:
+            shared = msgspec.json.decode(data, type=_SharedToken)
+        except msgspec.DecodeError:
+            return False
+        seconds_left = shared.expires_at - time.time()
+        if seconds_left <= TOKEN_REFRESH_MARGIN:
+            return False
+        self._access_token = shared.token
+        self._set_token_lifetime(seconds_left)
+        return True
+
+    async def _store_shared_token(self) -> None:
+        assert self._redis is not None and self._access_token is not None
+        ttl = int(self._token_expires_at_wall - time.time())
+        if ttl <= 0:
+            return
+        shared = _SharedToken(token=self._access_token, expires_at=self._token_expires_at_wall)
+        try:
+            await self._redis.set(TOKEN_CACHE_KEY, msgspec.json.encode(shared), ex=ttl)
+        except RedisError:
+            logger.warning("Не удалось сохранить токен GigaChat в Redis", exc_info=True)
 
-    def _build_basic_auth(self) -> str:
-        raw = f"{self._config.client_id}:{self._config.client_secret}".encode("utf-8")
-        return base64.b64encode(raw).decode("utf-8")
+    async def _obtain_token(self) -> None:
+        """Reuse the token shared via Redis or request a new one."""
 
-    def _refresh_token(self) -> None:
+        if self._redis is None:
+            await self._refresh_token()
+            return
+        if await self._load_shared_token():
+            return
+
+        # Между воркерами токен обновляет только владелец блокировки в Redis,
+        # остальные после её освобождения подхватывают уже сохранённый токен.
+        lock = self._redis.lock(
+            TOKEN_LOCK_KEY,
+            timeout=self._config.timeout + 10,
+            blocking_timeout=self._config.timeout,
+        )
+        try:
+            acquired = await lock.acquire()
+        except RedisError:
+            logger.warning("Не удалось взять блокировку обновления токена в Redis", exc_info=True)
+            acquired = False
+        try:
+            if acquired and await self._load_shared_token():
+                return
+            await self._refresh_token()
+            await self._store_shared_token()
+        finally:
+            if acquired:
+                try:
+                    await lock.release()
+                except RedisError:
+                    logger.warning("Не удалось снять блокировку обновления токена", exc_info=True)
+
+    async def _refresh_token(self) -> None:
         headers = {
             "Content-Type": "application/x-www-form-urlencoded",
             "Accept": "application/json",
-            "Authorization": f"Basic {self._build_basic_auth()}",
+            "Authorization": f"Basic {self._basic_auth}",
             "RqUID": str(uuid.uuid4()),
         }
         data = {"scope": self._config.scope}
 
-        response = self._session.post(
-            TOKEN_URL,
-            headers=headers,
-            data=data,
-            timeout=self._config.timeout,
-            verify=self._config.verify_ssl,
-        )
+        try:
+            response = await self._session.post(TOKEN_URL, headers=headers, data=data)
+        except httpx.HTTPError as exc:
+            raise GigaChatError(f"Failed to obtain access token: {exc}") from exc
         if response.status_code != 200:
             raise GigaChatError(
                 f"Failed to obtain access token: {response.status_code} {response.text}"
             )
 
-        payload = response.json()
+        try:
+            payload = msgspec.json.decode(response.content)
+        except msgspec.DecodeError as exc:
+            raise GigaChatError("Malformed token response from GigaChat") from exc
         self._access_token = payload.get("access_token")
         if not self._access_token:
             raise GigaChatError("Malformed token response from GigaChat")
@@ -84,9 +191,9 @@ class GigaChatClient:
 
         if isinstance(expires_at, str):
             try:
-                parsed = dt.datetime.fromisoformat(expires_at.replace("Z", "+00:00"))
-                self._token_expires_at = (
-                    parsed.astimezone(dt.timezone.utc).replace(tzinfo=None)
+                # С Python 3.11 fromisoformat понимает суффикс «Z» без подмены на +00:00.
+                self._set_token_lifetime(
+                    dt.datetime.fromisoformat(expires_at).timestamp() - time.time()
                 )
                 return
             except ValueError:
@@ -98,9 +205,9 @@ class GigaChatClient:
             if value > 1e11:  # вероятно миллисекунды
                 value = value / 1000.0
             if value > 1e9:  # секунды с эпохи
-                self._token_expires_at = dt.datetime.utcfromtimestamp(value)
+                self._set_token_lifetime(value - time.time())
             else:  # интервал в секундах
-                self._token_expires_at = dt.datetime.utcnow() + dt.timedelta(seconds=value)
+                self._set_token_lifetime(value)
             return
 
         if expires_in is not None:
@@ -108,18 +215,158 @@ class GigaChatClient:
                 seconds = float(expires_in)
             except (TypeError, ValueError):
                 seconds = 55 * 60
-            self._token_expires_at = dt.datetime.utcnow() + dt.timedelta(seconds=seconds)
+            self._set_token_lifetime(seconds)
             return
 
-        self._token_expires_at = dt.datetime.utcnow() + dt.timedelta(seconds=55 * 60)
+        self._set_token_lifetime(55 * 60)
 
-    def _ensure_token(self) -> None:
+    async def _ensure_token(self) -> None:
         if not self._token_is_valid():
-            self._refresh_token()
+            # Блокировка не даёт параллельным запросам одновременно обновлять токен.
+            async with self._token_lock:
+                if not self._token_is_valid():
+                    await self._obtain_token()
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._background_refresh())
+
+    async def _background_refresh(self) -> None:
+        """Refresh the token shortly before it expires so requests rarely wait for it."""
+
+        while True:
+            seconds_left = self._token_expires_at_monotonic - time.monotonic()
+            delay = max(seconds_left - TOKEN_REFRESH_MARGIN, TOKEN_RETRY_DELAY)
+            await asyncio.sleep(delay)
+            try:
+                async with self._token_lock:
+                    await self._obtain_token()
+            except GigaChatError:
+                logger.warning("Фоновое обновление токена GigaChat не удалось", exc_info=True)
+
+    def _cache_key(self, system_prompt: str, user_prompt: str, temperature: float) -> bytes:
+        raw = f"{self._config.model}\x00{system_prompt}\x00{user_prompt}\x00{temperature}"
+        return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).digest()
+
+    async def _cache_get(self, key: bytes) -> Optional[str]:
+        if self._cache is None:
+            return None
+        cached = self._cache.get(key)
+        if cached is not None or self._redis is None:
+            return cached
+        try:
+            shared = await self._redis.get(COMPLETION_CACHE_PREFIX + key.hex())
+        except RedisError:
+            logger.warning("Не удалось прочитать кеш GigaChat из Redis", exc_info=True)
+            return None
+        if shared is None:
+            return None
+        cached = shared.decode("utf-8") if isinstance(shared, bytes) else shared
+        self._cache[key] = cached
+        return cached
+
+    async def _cache_set(self, key: bytes, content: str) -> None:
+        if self._cache is None:
+            return
+        self._cache[key] = content
+        if self._redis is None:
+            return
+        try:
+            await self._redis.set(
+                COMPLETION_CACHE_PREFIX + key.hex(), content, ex=self._config.cache_ttl
+            )
+        except RedisError:
+            logger.warning("Не удалось записать кеш GigaChat в Redis", exc_info=True)
+
+    async def generate_completion(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        temperature: float = 0.7,
+        validate: Optional[Callable[[str], object]] = None,
+        read_cache: bool = True,
+    ) -> str:
+        """Return a completion, cached unless it is empty or `validate` raises on it.
+
+        With `read_cache=False` a fresh completion is requested, but it still
+        replaces the cached one.
+        """
+
+        key = self._cache_key(system_prompt, user_prompt, temperature)
+        cached = await self._cache_get(key) if read_cache else None
+        if cached is not None:
+            return cached
+
+        content = await self._request_completion(system_prompt, user_prompt, temperature)
+        if not content:
+            return content
+        if validate is not None:
+            validate(content)
+        await self._cache_set(key, content)
+        return content
+
+    async def stream_completion(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        temperature: float = 0.7,
+        read_cache: bool = True,
+    ) -> AsyncIterator[str]:
+        """Yield the completion text in chunks as GigaChat generates it (SSE)."""
+
+        key = self._cache_key(system_prompt, user_prompt, temperature)
+        cached = await self._cache_get(key) if read_cache else None
+        if cached is not None:
+            yield cached
+            return
 
-    def generate_completion(self, system_prompt: str, user_prompt: str, temperature: float = 0.7) -> str:
-        self._ensure_token()
+        await self._ensure_token()
+        headers, body = self._chat_request(system_prompt, user_prompt, temperature)
+        headers["Accept"] = "text/event-stream"
+        body["stream"] = True
 
+        chunks: list[str] = []
+        await self._semaphore.acquire()
+        holding = True
+        try:
+            async with self._session.stream(
+                "POST", CHAT_URL, headers=headers, content=msgspec.json.encode(body)
+            ) as response:
+                if response.status_code != 200:
+                    await response.aread()
+                    raise GigaChatError(
+                        f"GigaChat generation failed: {response.status_code} {response.text}"
+                    )
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[len("data:"):].strip()
+                    if data == "[DONE]":
+                        break
+                    try:
+                        delta = msgspec.json.decode(data)["choices"][0]["delta"].get("content")
+                    except (msgspec.DecodeError, KeyError, IndexError, TypeError) as exc:
+                        raise GigaChatError("Unexpected stream format from GigaChat") from exc
+                    if delta:
+                        chunks.append(delta)
+                        # Слот семафора не держим, пока потребитель обрабатывает кусок
+                        # (например, ждёт правку сообщения в Telegram).
+                        self._semaphore.release()
+                        holding = False
+                        yield delta
+                        await self._semaphore.acquire()
+                        holding = True
+        except httpx.HTTPError as exc:
+            raise GigaChatError(f"GigaChat generation failed: {exc}") from exc
+        finally:
+            if holding:
+                self._semaphore.release()
+
+        content = "".join(chunks).strip()
+        if content:
+            await self._cache_set(key, content)
+
+    def _chat_request(
+        self, system_prompt: str, user_prompt: str, temperature: float
+    ) -> tuple[dict[str, str], dict[str, Any]]:
         headers = {
             "Content-Type": "application/json",
             "Accept": "application/json",
@@ -133,24 +380,52 @@ class GigaChatClient:
             ],
             "temperature": temperature,
         }
+        return headers, body
 
-        response = self._session.post(
-            CHAT_URL,
-            headers=headers,
-            json=body,
-            timeout=self._config.timeout,
-            verify=self._config.verify_ssl,
-        )
+    async def _request_completion(
+        self, system_prompt: str, user_prompt: str, temperature: float
+    ) -> str:
+        await self._ensure_token()
+        headers, body = self._chat_request(system_prompt, user_prompt, temperature)
+
+        try:
+            async with self._semaphore:
+                response = await self._session.post(
+                    CHAT_URL, headers=headers, content=msgspec.json.encode(body)
+                )
+        except httpx.HTTPError as exc:
+            raise GigaChatError(f"GigaChat generation failed: {exc}") from exc
 
         if response.status_code != 200:
             raise GigaChatError(
                 f"GigaChat generation failed: {response.status_code} {response.text}"
             )
 
-        payload = response.json()
         try:
+            payload = msgspec.json.decode(response.content)
             content = payload["choices"][0]["message"]["content"]
-        except (KeyError, IndexError) as exc:
+        except (msgspec.DecodeError, KeyError, IndexError, TypeError) as exc:
             raise GigaChatError("Unexpected response format from GigaChat") from exc
         return content.strip()
 
+    async def aclose(self) -> None:
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._refresh_task
+            self._refresh_task = None
+        await self._session.aclose()
+
+    async def generate_many(
+        self, prompts: Iterable[tuple[str, str]], temperature: float = 0.7
+    ) -> list[str]:
+        """Run several (system_prompt, user_prompt) completions concurrently."""
+
+        return list(
+            await asyncio.gather(
+                *(
+                    self.generate_completion(system_prompt, user_prompt, temperature)
+                    for system_prompt, user_prompt in prompts
+                )
+            )
+        )
@@ -2,51 +2,65 @@
 
 from __future__ import annotations
 
-import json
 import re
 from typing import List
 
+import msgspec
+
 from .state import Idea
 
 
+_JSON_ARRAY_RE = re.compile(rb"\[.*\]", re.DOTALL)
+_IDEAS_DECODER = msgspec.json.Decoder(List[Idea])
+
+
 class IdeaParsingError(RuntimeError):
     """Raised when the response with ideas cannot be interpreted."""
 
 
-def _extract_json_array(raw: str) -> str | None:
-    match = re.search(r"\[.*\]", raw, flags=re.DOTALL)
+def _extract_json_array(raw: bytes) -> bytes | None:
+    # Частый случай: ответ начинается с массива, а после него идёт лишний текст.
+    # Срез до последней `]` совпадает с жадным регулярным выражением, но без поиска.
+    stripped = raw.lstrip()
+    if stripped.startswith(b"["):
+        end = stripped.rfind(b"]")
+        return stripped[: end + 1] if end != -1 else None
+
+    match = _JSON_ARRAY_RE.search(raw)
     if not match:
         return None
-    return raw[match.start(): match.end()]
+    return match.group()
+
+
+def _decode_ideas(raw: bytes) -> List[Idea]:
+    try:
+        return _IDEAS_DECODER.decode(raw)
+    except msgspec.ValidationError as exc:
+        raise IdeaParsingError(f"Ожидался JSON-массив с идеями: {exc}") from exc
 
 
 def parse_ideas(raw: str) -> List[Idea]:
+    buf = raw.encode("utf-8")
     try:
-        payload = json.loads(raw)
-    except json.JSONDecodeError:
-        extracted = _extract_json_array(raw)
+        payload = _decode_ideas(buf)
+    except msgspec.DecodeError:
+        extracted = _extract_json_array(buf)
         if not extracted:
             raise IdeaParsingError("Ответ с идеями не является валидным JSON")
         try:
-            payload = json.loads(extracted)
-        except json.JSONDecodeError as exc:
+            payload = _decode_ideas(extracted)
+        except msgspec.DecodeError as exc:
             raise IdeaParsingError("Ответ с идеями не является валидным JSON") from exc
 
-    if not isinstance(payload, list):
-        raise IdeaParsingError("Ожидался JSON-массив с идеями")
-
-    ideas: List[Idea] = []
-    for index, item in enumerate(payload, start=1):
-        if not isinstance(item, dict):
-            raise IdeaParsingError(f"Элемент №{index} не является объектом")
-        title = item.get("title")
-        description = item.get("description")
-        if not title or not description:
+    ideas = [
+        Idea(title=item.title.strip(), description=item.description.strip())
+        for item in payload
+    ]
+    for index, idea in enumerate(ideas, start=1):
+        if not idea.title or not idea.description:
             raise IdeaParsingError(f"У идеи №{index} отсутствуют необходимые поля")
-        ideas.append(Idea(title=str(title).strip(), description=str(description).strip()))
 
     if len(ideas) < 1:
         raise IdeaParsingError("AI не вернул ни одной идеи")
 
     return ideas
-
@@ -22,6 +22,13 @@ def _require(name: str) -> str:
     return value
 
 
+def _get_optional(name: str) -> str | None:
+    value = os.getenv(name)
+    if value is None or value.strip() == "":
+        return None
+    return value.strip()
+
+
 def _get_bool(name: str, default: bool = False) -> bool:
     value = os.getenv(name)
     if value is None:
@@ -48,6 +55,9 @@ class Settings:
     gigachat_client_secret: str
     telegram_disable_ssl_verify: bool = False
     gigachat_verify_ssl: bool | str = False
+    telegram_webhook_url: str | None = None
+    telegram_webhook_secret: str | None = None
+    redis_url: str | None = None
 
 
 def get_settings() -> Settings:
@@ -59,5 +69,8 @@ def get_settings() -> Settings:
         gigachat_client_secret=_require("GIGACHAT_CLIENT_SECRET"),
         telegram_disable_ssl_verify=_get_bool("TELEGRAM_DISABLE_SSL_VERIFY"),
         gigachat_verify_ssl=_get_verify_ssl("GIGACHAT_VERIFY_SSL"),
+        telegram_webhook_url=_get_optional("TELEGRAM_WEBHOOK_URL"),
+        telegram_webhook_secret=_get_optional("TELEGRAM_WEBHOOK_SECRET"),
+        redis_url=_get_optional("REDIS_URL"),
     )
 
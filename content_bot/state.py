@@ -1,40 +1,122 @@
-"""In-memory user state management for the bot."""
+"""User state management for the bot (in memory or in Redis)."""
 
 from __future__ import annotations
 
-from dataclasses import dataclass, field
-from typing import Dict, List, Optional
+import uuid
+from typing import List, Optional
 
+import msgspec
+from cachetools import TTLCache
+from redis.asyncio import Redis
+from redis.exceptions import WatchError
 
-@dataclass
-class Idea:
+
+STATE_KEY_PREFIX = "state:"
+STATE_TTL_SECONDS = 60 * 60
+STATE_MAX_USERS = 100_000
+
+
+class Idea(msgspec.Struct, frozen=True):
     title: str
     description: str
 
 
-@dataclass
-class UserState:
+class UserState(msgspec.Struct):
     step: str = "waiting_niche"
     niche: Optional[str] = None
     goal: Optional[str] = None
     content_format: Optional[str] = None
-    ideas: List[Idea] = field(default_factory=list)
+    ideas: List[Idea] = msgspec.field(default_factory=list)
     selected_index: Optional[int] = None
+    # Идентификатор прохода сценария: меняется при каждом сбросе (/start, «новый набор»).
+    flow_id: str = ""
+    # Сценарий запущен кнопкой «Сгенерировать новый набор»: кеш ответов не читаем.
+    fresh_completions: bool = False
 
 
 class StateManager:
-    def __init__(self) -> None:
-        self._storage: Dict[int, UserState] = {}
+    """Stores `UserState` per user, in Redis when a client is given.
+
+    Both backends expire a session after `ttl` seconds without changes.
+    `get` always returns a detached copy; changes are persisted with `save`
+    or, after a long await, with `save_if_current`.
+    """
+
+    def __init__(
+        self,
+        redis: Optional[Redis] = None,
+        ttl: int = STATE_TTL_SECONDS,
+        max_users: int = STATE_MAX_USERS,
+    ) -> None:
+        self._redis = redis
+        self._ttl = ttl
+        # Без Redis состояния живут в памяти: заброшенные сессии вытесняются по TTL и LRU.
+        self._storage: TTLCache[int, UserState] = TTLCache(maxsize=max_users, ttl=ttl)
+
+    async def get(self, user_id: int) -> UserState:
+        if self._redis is None:
+            state = self._storage.get(user_id)
+            if state is None:
+                return await self.reset(user_id)
+            return msgspec.structs.replace(state)
+
+        data = await self._redis.get(f"{STATE_KEY_PREFIX}{user_id}")
+        if data is None:
+            return await self.reset(user_id)
+        return msgspec.json.decode(data, type=UserState)
+
+    async def save(self, user_id: int, state: UserState) -> None:
+        if self._redis is None:
+            self._storage[user_id] = msgspec.structs.replace(state)
+            return
+        await self._redis.setex(
+            f"{STATE_KEY_PREFIX}{user_id}", self._ttl, msgspec.json.encode(state)
+        )
+
+    async def save_if_current(self, user_id: int, state: UserState, expected_step: str) -> bool:
+        """Save `state` only if the stored one is still the same flow at `expected_step`.
+
+        Returns False when the user restarted the flow (or it moved on) meanwhile.
+        """
+
+        if self._redis is None:
+            current = self._storage.get(user_id)
+            if not _is_same_flow(current, state, expected_step):
+                return False
+            self._storage[user_id] = msgspec.structs.replace(state)
+            return True
+
+        key = f"{STATE_KEY_PREFIX}{user_id}"
+        async with self._redis.pipeline(transaction=True) as pipe:
+            try:
+                await pipe.watch(key)
+                data = await pipe.get(key)
+                current = None if data is None else msgspec.json.decode(data, type=UserState)
+                if not _is_same_flow(current, state, expected_step):
+                    await pipe.unwatch()
+                    return False
+                pipe.multi()
+                pipe.setex(key, self._ttl, msgspec.json.encode(state))
+                await pipe.execute()
+            except WatchError:
+                return False
+        return True
 
-    def get(self, user_id: int) -> UserState:
-        if user_id not in self._storage:
-            self._storage[user_id] = UserState()
-        return self._storage[user_id]
+    async def reset(self, user_id: int, fresh_completions: bool = False) -> UserState:
+        state = UserState(flow_id=uuid.uuid4().hex, fresh_completions=fresh_completions)
+        await self.save(user_id, state)
+        return msgspec.structs.replace(state)
 
-    def reset(self, user_id: int) -> UserState:
-        self._storage[user_id] = UserState()
-        return self._storage[user_id]
+    async def remove(self, user_id: int) -> None:
+        if self._redis is None:
+            self._storage.pop(user_id, None)
+            return
+        await self._redis.delete(f"{STATE_KEY_PREFIX}{user_id}")
 
-    def remove(self, user_id: int) -> None:
-        self._storage.pop(user_id, None)
 
+def _is_same_flow(current: Optional[UserState], state: UserState, expected_step: str) -> bool:
+    return (
+        current is not None
+        and current.flow_id == state.flow_id
+        and current.step == expected_step
+    )
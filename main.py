@@ -1,10 +1,20 @@
-"""Run the Telegram bot in polling mode."""
+"""Run the Telegram bot as a webhook ASGI app or in polling mode."""
 
 from __future__ import annotations
 
+import asyncio
+import contextlib
+import hmac
 import logging
+from typing import AsyncIterator
 
-from content_bot.bot_app import create_app
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import Route
+
+from content_bot.bot_app import create_app, get_update_handler
+from content_bot.settings import get_settings
 
 
 logging.basicConfig(
@@ -12,12 +22,76 @@ logging.basicConfig(
     format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
 )
 
+logger = logging.getLogger(__name__)
+
+
+WEBHOOK_PATH = "/telegram/{secret}"
+SHUTDOWN_GRACE_SECONDS = 30.0
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: Starlette) -> AsyncIterator[None]:
+    settings = get_settings()
+    if not settings.telegram_webhook_url or not settings.telegram_webhook_secret:
+        raise RuntimeError(
+            "Для режима webhook задайте TELEGRAM_WEBHOOK_URL и TELEGRAM_WEBHOOK_SECRET. См. README.md"
+        )
+
+    bot, close = create_app()
+    app.state.webhook_secret = settings.telegram_webhook_secret
+    app.state.process_update = get_update_handler(bot)
+    app.state.update_tasks = set()
+
+    webhook_url = settings.telegram_webhook_url.rstrip("/") + WEBHOOK_PATH.format(
+        secret=settings.telegram_webhook_secret
+    )
+    try:
+        await bot.set_webhook(url=webhook_url)
+        logger.info("Webhook зарегистрирован")
+        yield
+    finally:
+        # Обновления уже подтверждены Telegram и повторно не придут: даём им доработать.
+        tasks = app.state.update_tasks
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=SHUTDOWN_GRACE_SECONDS)
+            for task in pending:
+                task.cancel()
+            if pending:
+                logger.warning("Прервано необработанных обновлений: %d", len(pending))
+                await asyncio.gather(*pending, return_exceptions=True)
+        await close()
+
+
+async def telegram_webhook(request: Request) -> Response:
+    state = request.app.state
+    if not hmac.compare_digest(request.path_params["secret"], state.webhook_secret):
+        return Response(status_code=404)
+    # Отвечаем Telegram сразу: иначе долгая генерация приведёт к повторной доставке
+    # обновления. Ссылку на задачу держим, пока она не завершится.
+    task = asyncio.create_task(state.process_update(await request.json()))
+    state.update_tasks.add(task)
+    task.add_done_callback(state.update_tasks.discard)
+    return Response()
+
+
+app = Starlette(
+    routes=[Route(WEBHOOK_PATH, telegram_webhook, methods=["POST"])],
+    lifespan=lifespan,
+)
+
+
+async def run_polling() -> None:
+    bot, close = create_app()
+    try:
+        await bot.delete_webhook()
+        await bot.infinity_polling(timeout=30)
+    finally:
+        await close()
+
 
 def main() -> None:
-    bot = create_app()
-    bot.infinity_polling(timeout=30, long_polling_timeout=30)
+    asyncio.run(run_polling())
 
 
 if __name__ == "__main__":
     main()
-